@@ -11,6 +11,11 @@ import re
 import curses
 import string
 import logging
+import os
+import errno
+import argparse
+import hashlib
+import stat
 
 class ClientCommand(object):
     CONNECT, SEND, DATA, CLOSE = range(4)
@@ -159,6 +164,10 @@ class SocketClientThread(threading.Thread):
         self.reply_q.put(ClientReply(cmd.type, ClientReply.SUCCESS, cmd))
 
     def _handle_SEND(self, cmd):
+        if not self.socket:
+            self.reply_q.put(ClientReply(cmd.type, ClientReply.ERROR, "Not connected"))
+            return
+
         try:
             self.socket.sendall(struct.pack("BB", (len(cmd.data) >> 8 & 0xFF), len(cmd.data) & 0xFF) + cmd.data)
             self.reply_q.put(ClientReply(cmd.type, ClientReply.SUCCESS, cmd))
@@ -175,6 +184,249 @@ def data_get_str(data):
 
     return data, s
 
+def packet_frame(data):
+    if len(data) > 0x7fff:
+        return struct.pack("3B", 0x80 | (len(data) >> 16 & 0x7f), len(data) >> 8 & 0xff, len(data) & 0xff) + data
+
+    return struct.pack("2B", len(data) >> 8 & 0xff, len(data) & 0xff) + data
+
+class RelaySubscriber(object):
+    def __init__(self, sock, limit):
+        self.socket = sock
+        self.socket.setblocking(0)
+        self.limit = limit
+        self.buffer = bytearray()
+        self.snapshot = 0
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def queue_snapshot(self, frame):
+        # The snapshot may exceed the limit; only the backlog behind it counts.
+        self.buffer += frame
+        self.snapshot = len(frame)
+
+    def queue(self, frame):
+        backlog = len(self.buffer) - self.snapshot
+
+        # A single frame larger than the limit is fine once the backlog is sent.
+        if backlog and backlog + len(frame) > self.limit:
+            return False
+
+        self.buffer += frame
+        return True
+
+    def flush(self):
+        try:
+            sent = self.socket.send(self.buffer)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+
+            return False
+
+        del self.buffer[:sent]
+        self.snapshot = max(0, self.snapshot - sent)
+        return True
+
+class RelayThread(threading.Thread):
+    SNAPSHOT, DELTA = range(2)
+
+    def __init__(self, path, limit = 256 * 1024):
+        super(RelayThread, self).__init__()
+        self.cmd_q = queue.Queue()
+        self.alive = threading.Event()
+        self.alive.set()
+        self.path = path
+        self.limit = limit
+        self.subscribers = []
+        self.tiles = {}
+        self.pending = set()
+        self.pos = (0, 0)
+
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise IOError("Relay path exists and is not a socket: {}".format(path))
+
+            os.unlink(path)
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen(5)
+
+    def join(self, timeout = None):
+        self.alive.clear()
+        threading.Thread.join(self, timeout)
+
+    def frame(self, type, coords):
+        return packet_frame(struct.pack("!B2h", type, *self.pos) + b"".join(self.tiles.get(coord, struct.pack("!2hB", coord[0], coord[1], 0)) for coord in coords))
+
+    def drop(self, subscriber, reason):
+        logging.info("Dropping relay subscriber: {}".format(reason))
+        subscriber.socket.close()
+        self.subscribers.remove(subscriber)
+
+    def broadcast(self, frame):
+        for subscriber in self.subscribers[:]:
+            if not subscriber.queue(frame):
+                self.drop(subscriber, "send buffer full")
+
+    def run(self):
+        while self.alive.isSet():
+            while True:
+                try:
+                    cmd = self.cmd_q.get_nowait()
+                except queue.Empty as e:
+                    break
+
+                self.pos, tiles = cmd.data
+
+                for coord, data in tiles.items():
+                    if data[4:5] == b"\0":
+                        self.tiles.pop(coord, None)
+                    else:
+                        self.tiles[coord] = data
+
+                    self.pending.add(coord)
+
+            if self.pending:
+                self.broadcast(self.frame(self.DELTA, self.pending))
+                self.pending = set()
+
+            r, w, e = select.select([self.socket] + self.subscribers, [s for s in self.subscribers if s.buffer], [], 0.01)
+
+            for subscriber in w:
+                if not subscriber.flush():
+                    self.drop(subscriber, "send failed")
+
+            for obj in r:
+                if obj is self.socket:
+                    sock, addr = self.socket.accept()
+                    subscriber = RelaySubscriber(sock, self.limit)
+                    self.subscribers.append(subscriber)
+                    subscriber.queue_snapshot(self.frame(self.SNAPSHOT, list(self.tiles.keys())))
+                    logging.info("New relay subscriber")
+                elif obj in self.subscribers:
+                    try:
+                        data = obj.socket.recv(4096)
+                    except socket.error as e:
+                        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            continue
+
+                        data = None
+
+                    if not data:
+                        self.drop(obj, "connection closed")
+
+        for subscriber in self.subscribers:
+            subscriber.socket.close()
+
+        self.socket.close()
+        os.unlink(self.path)
+
+class MapCacheThread(threading.Thread):
+    def __init__(self, path, interval = 2.0):
+        super(MapCacheThread, self).__init__()
+        self.cmd_q = queue.Queue()
+        self.reply_q = queue.Queue()
+        self.alive = threading.Event()
+        self.alive.set()
+        self.path = path
+        self.interval = interval
+        self.pending = {}
+        self.next_flush = time.time() + interval
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.handlers = {
+            ClientCommand.CONNECT: self._handle_CONNECT,
+            ClientCommand.SEND: self._handle_SEND,
+            ClientCommand.CLOSE: self._handle_CLOSE,
+        }
+
+    def join(self, timeout = None):
+        self.alive.clear()
+        threading.Thread.join(self, timeout)
+
+    def filename(self, name):
+        safe = re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_")
+        return os.path.join(self.path, "{}-{}.map".format(safe, hashlib.sha1(name.encode("utf-8")).hexdigest()[:8]))
+
+    def flush(self):
+        for name, records in self.pending.items():
+            try:
+                with open(self.filename(name), "ab") as f:
+                    f.write(b"".join(records))
+            except IOError as e:
+                logging.error("Failed to save map cache for {}: {}".format(name, e))
+
+        self.pending = {}
+        self.next_flush = time.time() + self.interval
+
+    def _handle_CONNECT(self, cmd):
+        records = {}
+        tiles = {}
+        num = 0
+
+        try:
+            with open(self.filename(cmd.data), "rb") as f:
+                data = f.read()
+        except IOError:
+            data = bytes()
+
+        while len(data) >= 3:
+            x, y, num_layers = struct.unpack("!3B", data[:3])
+            size = 3 + num_layers * 3
+
+            if len(data) < size:
+                logging.warning("Truncated map cache for {}".format(cmd.data))
+                break
+
+            records[(x, y)] = data[:size]
+            tiles[(x, y)] = dict(struct.unpack("!BH", data[i:i + 3]) for i in range(3, size, 3))
+            data = data[size:]
+            num += 1
+
+        # Rewrite the file when most of it is superseded records.
+        if num > len(records) * 2:
+            try:
+                with open(self.filename(cmd.data) + ".tmp", "wb") as f:
+                    f.write(b"".join(records.values()))
+
+                if hasattr(os, "replace"):
+                    os.replace(self.filename(cmd.data) + ".tmp", self.filename(cmd.data))
+                else:
+                    # Python 2: rename cannot overwrite an existing file on Windows.
+                    if os.name == "nt":
+                        os.remove(self.filename(cmd.data))
+
+                    os.rename(self.filename(cmd.data) + ".tmp", self.filename(cmd.data))
+            except (IOError, OSError) as e:
+                logging.error("Failed to compact map cache for {}: {}".format(cmd.data, e))
+
+        self.reply_q.put(ClientReply(ClientCommand.DATA, ClientReply.SUCCESS, (cmd.data, tiles)))
+
+    def _handle_SEND(self, cmd):
+        name, records = cmd.data
+        self.pending.setdefault(name, []).extend(records)
+
+    def _handle_CLOSE(self, cmd):
+        self.flush()
+
+    def run(self):
+        while self.alive.isSet():
+            try:
+                cmd = self.cmd_q.get(True, 0.1)
+                self.handlers[cmd.type](cmd)
+            except queue.Empty as e:
+                pass
+
+            if self.pending and time.time() >= self.next_flush:
+                self.flush()
+
+        self.flush()
+
 class CommandHandler:
     def handle_command_map(self, data):
         mapstat = struct.unpack("!B", data[:1])[0]
@@ -189,11 +441,15 @@ class CommandHandler:
                 width, height, xpos, ypos = struct.unpack("!4B", data[:4])
                 data = data[4:]
                 self.map.set_data(width, height, xpos, ypos)
+                self.map_effects_clear()
             else:
                 tile, xoff, yoff, xpos, ypos = struct.unpack("!B2b2B", data[:5])
                 data = data[5:]
 
                 self.map.mapscroll(xoff, yoff, xpos, ypos)
+
+            if self.map.set_name(mapname) and self.map_cache_thread:
+                self.map_cache_thread.cmd_q.put(ClientCommand(ClientCommand.CONNECT, mapname))
         else:
             xpos, ypos = struct.unpack("!2B", data[:2])
             data = data[2:]
@@ -278,10 +534,22 @@ class CommandHandler:
             data = data[1:]
 
             if ext_flags & CommandHandler.MAP2_FLAG_EXT_ANIM:
+                anim_type, = struct.unpack("!B", data[:1])
                 data = data[3:]
+                self.map_effect(x, y, anim_type)
 
-        height, width = self.wins["main"].getmaxyx()
-        self.show_text(self.map.render(width = width - 2, height = height))
+        changed = self.map.pop_changed()
+
+        if self.relay_thread:
+            self.relay_thread.cmd_q.put(ClientCommand(ClientCommand.DATA, (tuple(self.map.pos), dict((coord, self.map.tile_pack(*coord)) for coord in changed))))
+
+        if self.map_cache_thread:
+            records = [record for record in (self.map.memory_update(*coord) for coord in changed) if record]
+
+            if records:
+                self.map_cache_thread.cmd_q.put(ClientCommand(ClientCommand.SEND, (self.map.name, records)))
+
+        self.map_dirty.update(changed)
 
     def handle_command_characters(self, data):
         if len(data) == 0:
@@ -316,6 +584,26 @@ class CommandHandler:
     def handle_command_player(self, data):
         if self.state == self.ST_WAITPLAY:
             self.state += 1
+            self.keepalive_timer = self.timers.schedule(self.KEEPALIVE_INTERVAL, self.send_keepalive, interval = self.KEEPALIVE_INTERVAL)
+
+    def handle_command_stats(self, data):
+        while data:
+            type, = struct.unpack("!B", data[:1])
+            data = data[1:]
+
+            if not type in CommandHandler.stat_types:
+                logging.warning("Unknown stat type: {}".format(type))
+                return
+
+            name, fmt = CommandHandler.stat_types[type]
+
+            if fmt:
+                value, = struct.unpack(fmt, data[:struct.calcsize(fmt)])
+                data = data[struct.calcsize(fmt):]
+            else:
+                data, value = data_get_str(data)
+
+            self.cpl.stats.update(name, value)
 
     def handle_command_compressed(self, data):
         # TODO: implement?
@@ -354,7 +642,7 @@ class CommandHandler:
         ("Target", None),
         ("Update item", None),
         ("Delete item", None),
-        ("Player stats", None),
+        ("Player stats", handle_command_stats),
         ("Image", None),
         ("Animation", None),
         ("Ready skill", None),
@@ -376,6 +664,34 @@ class CommandHandler:
         ("Notification", None),
     ]
 
+    stat_types = {
+        1: ("hp", "!l"),
+        2: ("maxhp", "!l"),
+        3: ("sp", "!h"),
+        4: ("maxsp", "!h"),
+        5: ("str", "!b"),
+        6: ("int", "!b"),
+        7: ("wis", "!b"),
+        8: ("dex", "!b"),
+        9: ("con", "!b"),
+        10: ("cha", "!b"),
+        11: ("exp", "!Q"),
+        12: ("level", "!B"),
+        13: ("wc", "!H"),
+        14: ("ac", "!H"),
+        15: ("dam", "!H"),
+        17: ("speed", "!L"),
+        18: ("food", "!H"),
+        19: ("weapon_speed", "!L"),
+        22: ("pow", "!b"),
+        23: ("flags", "!H"),
+        24: ("weight_limit", "!L"),
+        25: ("ext_title", None),
+        26: ("reg_hp", "!H"),
+        27: ("reg_mana", "!H"),
+        29: ("target_hp", "!B"),
+    }
+
     MAP_UPDATE_CMD_SAME, \
     MAP_UPDATE_CMD_NEW, \
     MAP_UPDATE_CMD_CONNECTED = range(3)
@@ -401,6 +717,9 @@ class CommandHandler:
 
     MAP2_FLAG_EXT_ANIM = 1
 
+    ANIM_DAMAGE = 1
+    ANIM_KILL = 2
+
 class ServerCommands:
     CONTROL, \
     ASK_FACE, \
@@ -439,9 +758,46 @@ class ServerCommands:
     ACCOUNT_NEW_CHAR, \
     ACCOUNT_PSWD = range(6)
 
+class PlayerStats(object):
+    __slots__ = [name for name, fmt in CommandHandler.stat_types.values()] + ["dirty"]
+
+    rows = [
+        "Level {level}",
+        "Exp {exp}",
+        "HP {hp}/{maxhp}",
+        "SP {sp}/{maxsp}",
+        "Food {food}",
+        "WC {wc} AC {ac}",
+        "Dam {dam}",
+        "Str {str} Dex {dex}",
+        "Con {con} Int {int}",
+        "Wis {wis} Pow {pow}",
+        "Cha {cha}",
+    ]
+
+    def __init__(self):
+        for name, fmt in CommandHandler.stat_types.values():
+            setattr(self, name, 0 if fmt else "")
+
+        self.touch()
+
+    def touch(self):
+        self.dirty = set(name for name, fmt in CommandHandler.stat_types.values())
+
+    def update(self, name, value):
+        if getattr(self, name) != value:
+            setattr(self, name, value)
+            self.dirty.add(name)
+
+    def pop_dirty(self):
+        dirty = self.dirty
+        self.dirty = set()
+        return dirty
+
 class ClientPlayer(object):
     def __init__(self):
         self.socket_version = 0
+        self.stats = PlayerStats()
 
 class GameObject(object):
     def __init__(self):
@@ -452,13 +808,33 @@ class GameObject(object):
         self.inv = []
 
 class MapObject(object):
+    OBJ_PLAYER = 1
+    OBJ_TARGET = 2
+    OBJ_FRIEND = 4
+
     def __init__(self):
         self.tiles = {}
+        self.changed = set()
         self.xpos = 0
         self.ypos = 0
         self.pos = [0, 0]
+        self.name = None
+        self.memory = {}
+        self.memories = {}
+        self.effects = {}
+
+    @staticmethod
+    def layer_is_wall(layer):
+        return (layer + 1) % 7 == 5
 
     def set_data(self, width, height, xpos, ypos):
+        for x in self.tiles:
+            for y in self.tiles[x]:
+                self.changed.add((x, y))
+
+        self.changed.update(self.effects)
+        self.tiles = {}
+        self.effects = {}
         self.xpos = xpos
         self.ypos = ypos
         self.pos = [0, 0]
@@ -490,15 +866,82 @@ class MapObject(object):
         self.xpos = xpos
         self.ypos = ypos
 
+    def set_name(self, name):
+        if name == self.name:
+            return False
+
+        self.name = name
+        is_new = name not in self.memories
+        self.memory = self.memories.setdefault(name, {})
+        return is_new
+
+    def map_coords(self, x, y):
+        return x - self.pos[0] + self.xpos, y - self.pos[1] + self.ypos
+
+    def memory_load(self, name, tiles):
+        memory = self.memories.setdefault(name, {})
+
+        for coord, layers in tiles.items():
+            memory.setdefault(coord, layers)
+
+    def memory_update(self, x, y):
+        mx, my = self.map_coords(x, y)
+
+        if not 0 <= mx <= 0xff or not 0 <= my <= 0xff or not x in self.tiles or not y in self.tiles[x]:
+            return None
+
+        # Only remember the static layout; players and monsters move around.
+        layers = dict((layer, obj.face) for layer, obj in self.tiles[x][y].items() if obj and not hasattr(obj, "player_name") and not hasattr(obj, "count"))
+
+        if not layers or self.memory.get((mx, my)) == layers:
+            return None
+
+        self.memory[(mx, my)] = layers
+        return struct.pack("!3B", mx, my, len(layers)) + b"".join(struct.pack("!BH", layer, face) for layer, face in layers.items())
+
+    def overview(self, width = 20, height = 20):
+        l = [[" " for x in range(width)] for y in range(height)]
+
+        if not self.memory:
+            return "\n".join("".join(line) for line in l)
+
+        xs = [coord[0] for coord in self.memory]
+        ys = [coord[1] for coord in self.memory]
+        scale = max(1, -(-(max(xs) - min(xs) + 1) // width), -(-(max(ys) - min(ys) + 1) // height))
+
+        for (mx, my), layers in self.memory.items():
+            x = (mx - min(xs)) // scale
+            y = (my - min(ys)) // scale
+
+            if any(MapObject.layer_is_wall(layer) for layer in layers):
+                l[y][x] = "#"
+            elif l[y][x] == " ":
+                l[y][x] = "."
+
+        x = (self.xpos - min(xs)) // scale
+        y = (self.ypos - min(ys)) // scale
+
+        if 0 <= x < width and 0 <= y < height:
+            l[y][x] = "@"
+
+        return "\n".join("".join(line) for line in l)
+
+    def pop_changed(self):
+        changed = self.changed
+        self.changed = set()
+        return changed
+
     def tile_clear_layer(self, x, y, layer):
         try:
             self.tiles[x][y][layer] = None
+            self.changed.add((x, y))
         except KeyError:
             logging.warning("No such layer ({}) on tile: {},{}".format(layer, x, y))
 
     def tile_clear(self, x, y):
         try:
             self.tiles[x][y].clear()
+            self.changed.add((x, y))
         except KeyError:
             logging.warning("No such tile: {},{}".format(x, y))
 
@@ -515,32 +958,246 @@ class MapObject(object):
         for attr in data:
             setattr(self.tiles[x][y][layer], attr, data[attr])
 
+        self.changed.add((x, y))
+
+    def tile_effect(self, x, y, c):
+        if c:
+            self.effects[(x, y)] = c
+        else:
+            self.effects.pop((x, y), None)
+
+    def tile_pack(self, x, y):
+        layers = []
+
+        if x in self.tiles and y in self.tiles[x]:
+            for layer, obj in self.tiles[x][y].items():
+                if not obj:
+                    continue
+
+                flags = 0
+                name = b""
+
+                if hasattr(obj, "player_name"):
+                    flags |= MapObject.OBJ_PLAYER
+                    name = obj.player_name.encode("ascii") + b"\0"
+
+                if hasattr(obj, "count"):
+                    flags |= MapObject.OBJ_TARGET
+
+                    if obj.is_friend:
+                        flags |= MapObject.OBJ_FRIEND
+
+                layers.append(struct.pack("!BHB", layer, obj.face, flags) + name)
+
+        return struct.pack("!2hB", x, y, len(layers)) + b"".join(layers)
+
+    def tile_unpack(self, data):
+        x, y, num_layers = struct.unpack("!2hB", data[:5])
+        data = data[5:]
+
+        if x in self.tiles and y in self.tiles[x]:
+            self.tile_clear(x, y)
+
+        for i in range(num_layers):
+            layer, face, flags = struct.unpack("!BHB", data[:4])
+            data = data[4:]
+            obj_data = {"face": face}
+
+            if flags & MapObject.OBJ_PLAYER:
+                data, obj_data["player_name"] = data_get_str(data)
+
+            if flags & MapObject.OBJ_TARGET:
+                obj_data["count"] = 0
+                obj_data["is_friend"] = flags & MapObject.OBJ_FRIEND != 0
+
+            self.tile_update_object(x, y, layer, obj_data)
+
+        return data
+
+    def render_cell(self, x, y):
+        if (x, y) in self.effects:
+            return self.effects[(x, y)]
+
+        if not x in self.tiles or not any(self.tiles[x].get(y, {}).values()):
+            layers = self.memory.get(self.map_coords(x, y), {})
+            return "#" if any(MapObject.layer_is_wall(layer) for layer in layers) else " "
+
+        c = " "
+
+        for layer in self.tiles[x][y]:
+            obj = self.tiles[x][y][layer]
+
+            if not obj:
+                continue
+
+            c = " "
+
+            if hasattr(obj, "player_name"):
+                c = "P"
+            elif hasattr(obj, "count"):
+                c = "N" if obj.is_friend else "M"
+            elif MapObject.layer_is_wall(layer):
+                c = "#"
+
+        return c
+
     def render(self, width = 20, height = 20):
-        l = [[" " for x in range(width)] for y in range(height)]
+        return "\n".join("".join(self.render_cell(x, y) for x in range(self.pos[0] - width // 2, self.pos[0] + width // 2)) for y in range(self.pos[1] - height // 2, self.pos[1] + height // 2))
+
+class Timer(object):
+    def __init__(self, expires, callback, interval):
+        self.expires = expires
+        self.callback = callback
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class TimerWheel(object):
+    def __init__(self, resolution = 0.01, bits = 6, levels = 4):
+        self.resolution = resolution
+        self.bits = bits
+        self.levels = levels
+        self.mask = (1 << bits) - 1
+        self.wheels = [[[] for i in range(1 << bits)] for level in range(levels)]
+        self.start = time.time()
+        self.tick = 0
+
+    def _insert(self, timer):
+        # Wheel N holds timers due within 64 ** (N + 1) ticks, in the slot
+        # given by the matching bits of the expiry tick.
+        expires = min(timer.expires, self.tick + (1 << self.bits * self.levels) - 1)
+        delta = expires - self.tick
+
+        for level in range(self.levels):
+            if delta < 1 << self.bits * (level + 1) or level == self.levels - 1:
+                self.wheels[level][expires >> self.bits * level & self.mask].append(timer)
+                return
+
+    def schedule(self, delay, callback, interval = None):
+        ticks = lambda seconds: max(1, int(round(seconds / self.resolution)))
+        timer = Timer(self.tick + ticks(delay), callback, ticks(interval) if interval else None)
+        self._insert(timer)
+        return timer
+
+    def advance(self, now = None):
+        target = int(((now or time.time()) - self.start) / self.resolution)
+
+        while self.tick < target:
+            self.tick += 1
+
+            # Cascade timers from the outer wheels when the inner ones wrap.
+            for level in range(self.levels - 1, 0, -1):
+                if self.tick & (1 << self.bits * level) - 1 == 0:
+                    slot = self.wheels[level][self.tick >> self.bits * level & self.mask]
+                    self.wheels[level][self.tick >> self.bits * level & self.mask] = []
+
+                    for timer in slot:
+                        if not timer.cancelled:
+                            self._insert(timer)
+
+            slot = self.wheels[0][self.tick & self.mask]
+            self.wheels[0][self.tick & self.mask] = []
+
+            for timer in slot:
+                if timer.cancelled:
+                    continue
 
-        for x2, x in enumerate(range(self.pos[0] - width // 2, self.pos[0] + width // 2)):
-            for y2, y in enumerate(range(self.pos[1] - height // 2, self.pos[1] + height // 2)):
-                if not x in self.tiles or not y in self.tiles[x]:
+                if timer.expires > self.tick:
+                    self._insert(timer)
                     continue
 
-                for layer in self.tiles[x][y]:
-                    obj = self.tiles[x][y][layer]
+                timer.callback()
 
-                    if not obj:
-                        continue
+                if timer.interval and not timer.cancelled:
+                    timer.expires = self.tick + timer.interval
+                    self._insert(timer)
+
+class WindowCompositor(object):
+    def __init__(self, screen):
+        self.screen = screen
+        self.wins = {}
+        self.layouts = {}
+        self.staged = False
+        self.frames = 0
+        self.bytes = 0
+        self.max_bytes = 0
+        self.last_bytes = None
+
+        # Bytes written by this thread, which is the one that draws.
+        try:
+            self.io = open("/proc/self/task/{}/io".format(os.getpid()), "r")
+        except IOError:
+            self.io = None
 
-                    c = " "
+    def __getitem__(self, name):
+        return self.wins[name]
 
-                    if hasattr(obj, "player_name"):
-                        c = "P"
-                    elif hasattr(obj, "count"):
-                        c = "N" if obj.is_friend else "M"
-                    elif (layer + 1) % 7 == 5:
-                        c = "#"
+    def add(self, name, layout):
+        self.layouts[name] = layout
+        self.wins[name] = curses.newwin(*layout(*self.screen.getmaxyx()))
 
-                    l[y2][x2] = c
+    def refresh(self, name):
+        self.wins[name].noutrefresh()
+        self.staged = True
 
-        return "\n".join("".join(line) for line in l)
+    def written(self):
+        if not self.io:
+            return None
+
+        self.io.seek(0)
+
+        for line in self.io.read().splitlines():
+            if line.startswith("wchar:"):
+                return int(line.split()[1])
+
+        return None
+
+    def update(self):
+        if not self.staged:
+            return
+
+        before = self.written()
+        curses.doupdate()
+        after = self.written()
+        self.staged = False
+
+        if before is not None and after is not None:
+            self.last_bytes = after - before
+            self.frames += 1
+            self.bytes += self.last_bytes
+            self.max_bytes = max(self.max_bytes, self.last_bytes)
+
+    def log_stats(self):
+        if self.frames:
+            logging.info("tty: {} frames, {:.0f} bytes/frame on average, {} max".format(self.frames, self.bytes / float(self.frames), self.max_bytes))
+
+        self.frames = 0
+        self.bytes = 0
+        self.max_bytes = 0
+
+    def resize(self):
+        if hasattr(curses, "update_lines_cols"):
+            curses.update_lines_cols()
+
+        height, width = self.screen.getmaxyx()
+
+        # Terminals differ in what they keep on resize, so repaint it all once.
+        self.screen.clearok(True)
+        self.screen.noutrefresh()
+
+        for name, win in self.wins.items():
+            h, w, y, x = self.layouts[name](height, width)
+            cur_h, cur_w = win.getmaxyx()
+
+            # Shrink first so the window fits the screen wherever it moves.
+            win.resize(min(h, cur_h), min(w, cur_w))
+            win.mvwin(y, x)
+            win.resize(h, w)
+            win.erase()
+            win.box()
+            self.refresh(name)
 
 class Client(object):
     ST_INIT, \
@@ -559,21 +1216,29 @@ class Client(object):
     ST_WAITPLAY, \
     ST_PLAY = range(15)
 
-    def __init__(self, screen):
+    STATS_WIDTH = 22
+    KEEPALIVE_INTERVAL = 30.0
+    EFFECT_DURATION = 0.5
+    TTY_STATS_INTERVAL = 10.0
+
+    def __init__(self, screen, relay = None, map_cache = None):
         self.screen = screen
 
         curses.start_color()
         curses.init_pair(1, curses.COLOR_WHITE, curses.COLOR_BLACK)
 
         self.screen.bkgd(curses.color_pair(1))
-        self.screen.refresh()
+        self.screen.noutrefresh()
         self.screen.nodelay(1)
 
-        self.height, self.width = screen.getmaxyx()
+        self.wins = WindowCompositor(screen)
+        self.wins.add("main", lambda height, width: (height - 3, width - self.STATS_WIDTH, 0, 0))
+        self.wins.add("stats", lambda height, width: (height - 3, self.STATS_WIDTH, 0, width - self.STATS_WIDTH))
+        self.wins.add("status", lambda height, width: (3, width, height - 3, 0))
 
-        self.wins = {}
-        self.wins["main"] = curses.newwin(self.height - 3, self.width, 0, 0)
-        self.wins["status"] = curses.newwin(3, self.width, self.height - 3, 0)
+        self.wins["stats"].box()
+        self.wins.refresh("stats")
+        self.win_texts = {}
 
         self.socket_thread = SocketClientThread()
         self.socket_thread.start()
@@ -581,7 +1246,28 @@ class Client(object):
         self.metaserver_thread = MetaserverThread()
         self.metaserver_thread.start()
 
+        self.relay_thread = None
+
+        if relay:
+            self.relay_thread = RelayThread(relay)
+            self.relay_thread.start()
+
+        self.map_cache_thread = None
+
+        if map_cache:
+            self.map_cache_thread = MapCacheThread(map_cache)
+            self.map_cache_thread.start()
+
         self.map = MapObject()
+        self.map_dirty = set()
+        self.map_redraw = False
+        self.map_drawn_pos = None
+        self.show_overview = False
+        self.effect_timers = {}
+        self.timers = TimerWheel()
+        self.timers.schedule(self.TTY_STATS_INTERVAL, self.wins.log_stats, interval = self.TTY_STATS_INTERVAL)
+        self.keepalive_id = 0
+        self.keepalive_timer = None
 
         self.alive = True
         self.state = self.ST_INIT
@@ -589,8 +1275,12 @@ class Client(object):
 
     def show_text(self, text, center = True, win = "main", clear = True, align = None, valign = None):
         if clear:
-            self.wins[win].clear()
+            self.wins[win].erase()
             self.wins[win].box()
+            self.win_texts[win] = []
+
+        # Remembered so the window can be repainted after a resize.
+        self.win_texts.setdefault(win, []).append(dict(text = text, center = center, win = win, clear = clear, align = align, valign = valign))
 
         height, width = self.wins[win].getmaxyx()
         height -= 2
@@ -600,7 +1290,7 @@ class Client(object):
             align = "center"
             valign = "middle"
 
-        lines = text.split("\n")[-height:]
+        lines = [line[:width] for line in text.split("\n")[-height:]]
 
         if align == "right":
             longest = max(len(line) for line in lines)
@@ -621,7 +1311,112 @@ class Client(object):
 
             self.wins[win].addstr(y, x, line)
 
-        self.wins[win].refresh()
+        self.wins.refresh(win)
+
+    def draw_stats(self):
+        dirty = self.cpl.stats.pop_dirty()
+        height, width = self.wins["stats"].getmaxyx()
+
+        for y, row in enumerate(PlayerStats.rows[:height - 2]):
+            fields = [field for text, field, spec, conv in string.Formatter().parse(row) if field]
+
+            if not dirty.intersection(fields):
+                continue
+
+            text = row.format(**dict((field, getattr(self.cpl.stats, field)) for field in fields))
+            self.wins["stats"].addstr(y + 1, 1, text[:width - 2].ljust(width - 2))
+
+        self.wins.refresh("stats")
+
+    def draw_map(self):
+        height, width = self.wins["main"].getmaxyx()
+        self.map_dirty = set()
+        self.map_redraw = False
+        self.map_drawn_pos = tuple(self.map.pos)
+
+        if self.show_overview:
+            self.show_text(self.map.overview(width = width - 2, height = height - 2))
+        else:
+            self.show_text(self.map.render(width = width - 2, height = height - 2))
+
+    def draw_map_dirty(self):
+        if self.map_redraw or self.show_overview or self.map_drawn_pos != tuple(self.map.pos):
+            self.draw_map()
+            return
+
+        height, width = self.wins["main"].getmaxyx()
+        left = self.map.pos[0] - (width - 2) // 2
+        top = self.map.pos[1] - (height - 2) // 2
+
+        for x, y in self.map_dirty:
+            if 0 <= x - left < width - 2 and 0 <= y - top < height - 2:
+                self.wins["main"].addch(y - top + 1, x - left + 1, self.map.render_cell(x, y))
+
+        self.map_dirty = set()
+        self.wins.refresh("main")
+
+    def map_effect(self, x, y, anim_type):
+        if (x, y) in self.effect_timers:
+            self.effect_timers[(x, y)].cancel()
+
+        self.map.tile_effect(x, y, "x" if anim_type == CommandHandler.ANIM_KILL else "*")
+        self.map_dirty.add((x, y))
+        self.effect_timers[(x, y)] = self.timers.schedule(self.EFFECT_DURATION, lambda: self.map_effect_expire(x, y))
+
+    def map_effects_clear(self):
+        for timer in self.effect_timers.values():
+            timer.cancel()
+
+        self.effect_timers = {}
+
+    def map_effect_expire(self, x, y):
+        del self.effect_timers[(x, y)]
+        self.map.tile_effect(x, y, None)
+        self.map_dirty.add((x, y))
+
+    def send_keepalive(self):
+        self.keepalive_id += 1
+        self.send_command(ServerCommands.KEEPALIVE, struct.pack("!L", self.keepalive_id))
+
+    def getch(self):
+        c = self.screen.getch()
+
+        if c == curses.KEY_RESIZE:
+            self.resize()
+            return -1
+
+        return c
+
+    def resize(self):
+        self.wins.resize()
+
+        for win, calls in list(self.win_texts.items()):
+            self.win_texts[win] = []
+
+            for kwargs in calls:
+                self.show_text(**kwargs)
+
+        self.map_redraw = True
+
+        if self.state >= self.ST_CONNECT:
+            self.cpl.stats.touch()
+
+    def prompt(self, text, intro = True, echo = False):
+        if intro:
+            self.show_intro_gfx()
+
+        self.show_text(text, clear = not intro)
+        self.wins.update()
+
+        if echo:
+            curses.echo()
+
+        s = self.wins["main"].getstr()
+
+        if echo:
+            curses.noecho()
+
+        return s
 
     def connect(self, server):
         self.socket_thread.cmd_q.put(ClientCommand(ClientCommand.CONNECT, (server["host"], server["port"])))
@@ -690,6 +1485,10 @@ _- -   | | _- _
                         self.state += 1
                     elif cmd.cmd_type == ClientCommand.CLOSE:
                         logging.info("Closed due to: {}".format(cmd.data.data))
+
+                        if self.keepalive_timer:
+                            self.keepalive_timer.cancel()
+                            self.keepalive_timer = None
                     elif cmd.cmd_type == ClientCommand.DATA:
                         fnc = CommandHandler.commands[struct.unpack("B", cmd.data[:1])[0]][1]
 
@@ -700,6 +1499,17 @@ _- -   | | _- _
                 except queue.Empty as e:
                     break
 
+            while self.map_cache_thread:
+                try:
+                    cmd = self.map_cache_thread.reply_q.get_nowait()
+                    name, tiles = cmd.data
+                    self.map.memory_load(name, tiles)
+
+                    if name == self.map.name:
+                        self.map_redraw = True
+                except queue.Empty as e:
+                    break
+
             if self.state == self.ST_INIT:
                 self.show_intro_gfx()
                 self.show_text("Welcome to Atrinik!\nPlease wait, connecting to the metaserver...", clear = False)
@@ -708,7 +1518,7 @@ _- -   | | _- _
                 self.metaserver_thread.cmd_q.put(ClientCommand(ClientCommand.CONNECT, self.get_metaservers()))
                 self.state += 1
             elif self.state == self.ST_CHOOSESERVER:
-                c = self.screen.getch()
+                c = self.getch()
 
                 if c != -1 and chr(c) in self.selection_keys:
                     idx = self.selection_keys.index(chr(c))
@@ -729,36 +1539,23 @@ _- -   | | _- _
                 self.send_command(ServerCommands.SETUP, struct.pack("!BB", ServerCommands.SETUP_SOUND, 0))
                 self.state += 1
             elif self.state == self.ST_LOGIN:
-                c = self.screen.getch()
+                c = self.getch()
 
                 if c == ord("1"):
-                    self.show_intro_gfx()
-                    self.show_text("Enter your account name:\n", clear = False)
-                    curses.echo()
-                    name = self.wins["main"].getstr()
-                    curses.noecho()
-                    self.show_intro_gfx()
-                    self.show_text("Enter your account password:\n", clear = False)
-                    pswd = self.wins["main"].getstr()
+                    name = self.prompt("Enter your account name:\n", echo = True)
+                    pswd = self.prompt("Enter your account password:\n")
 
                     self.send_command(ServerCommands.ACCOUNT, struct.pack("B", ServerCommands.ACCOUNT_LOGIN) + name + b"\0" + pswd + b"\0")
                     self.state += 1
                 elif c == ord("2"):
-                    self.show_intro_gfx()
-                    self.show_text("Enter new account name:\n", clear = False)
-                    curses.echo()
-                    name = self.wins["main"].getstr()
-                    curses.noecho()
-                    self.show_intro_gfx()
-                    self.show_text("Enter password:\n")
-                    pswd = self.wins["main"].getstr()
-                    self.show_text("Verify password:\n")
-                    pswd2 = self.wins["main"].getstr()
+                    name = self.prompt("Enter new account name:\n", echo = True)
+                    pswd = self.prompt("Enter password:\n", intro = False)
+                    pswd2 = self.prompt("Verify password:\n", intro = False)
 
                     self.send_command(ServerCommands.ACCOUNT, "".join([struct.pack("!B", ServerCommands.ACCOUNT_REGISTER), name, "\0", pswd, "\0", pswd2, "\0"]))
                     self.state += 1
             elif self.state == self.ST_CHARACTERS:
-                c = self.screen.getch()
+                c = self.getch()
 
                 if c != -1 and chr(c) in self.selection_keys:
                     idx = self.selection_keys.index(chr(c))
@@ -767,7 +1564,7 @@ _- -   | | _- _
                         self.send_command(ServerCommands.ACCOUNT, struct.pack("!B", ServerCommands.ACCOUNT_LOGIN_CHAR) + self.characters[idx]["name"].encode("ascii"))
                         self.state += 1
             elif self.state == self.ST_PLAY:
-                c = self.screen.getch()
+                c = self.getch()
 
                 if c == curses.KEY_UP:
                     self.send_command(ServerCommands.MOVE, struct.pack("!2B", 1, 0))
@@ -777,18 +1574,34 @@ _- -   | | _- _
                     self.send_command(ServerCommands.MOVE, struct.pack("!2B", 3, 0))
                 elif c == curses.KEY_LEFT:
                     self.send_command(ServerCommands.MOVE, struct.pack("!2B", 7, 0))
+                elif c == ord("m"):
+                    self.show_overview = not self.show_overview
+                    self.map_redraw = True
+
+            self.timers.advance()
+
+            if self.state == self.ST_PLAY and (self.map_dirty or self.map_redraw):
+                self.draw_map_dirty()
+
+            if self.state == self.ST_PLAY and self.cpl.stats.dirty:
+                self.draw_stats()
+
+            self.wins.update()
 
             time.sleep(0.01)
 
-def main(screen):
+def main(screen, args):
     logging.basicConfig(filename = "client.log",
                         filemode = "w",
                         level = logging.DEBUG,
                         format = "%(asctime)s.%(msecs).03d %(levelname)8s: %(message)s",
                         datefmt = "%Y-%m-%d %H:%M:%S")
-    client = Client(screen)
+    client = Client(screen, relay = args.relay, map_cache = args.map_cache)
     client.state = client.ST_INIT
     client.loop()
 
 if __name__ == "__main__":
-    curses.wrapper(main)
+    parser = argparse.ArgumentParser(description = "Atrinik ASCII client.")
+    parser.add_argument("--relay", metavar = "PATH", help = "share the map view with spectators on this Unix socket")
+    parser.add_argument("--map-cache", metavar = "DIR", default = os.path.join(os.path.expanduser("~"), ".atrinik-ascii", "maps"), help = "directory for remembered map layouts")
+    curses.wrapper(main, parser.parse_args())
@@ -0,0 +1,324 @@
+import socket
+import select
+import struct
+import random
+import time
+import logging
+import argparse
+
+from main import CommandHandler, ServerCommands, data_get_str, packet_frame
+
+def command_index(name):
+    for i, (cmd_name, fnc) in enumerate(CommandHandler.commands):
+        if cmd_name == name:
+            return i
+
+    raise ValueError("Unknown command: {}".format(name))
+
+def pack_str(s):
+    return s.encode("ascii") + b"\0"
+
+def pack_stats(stats):
+    data = bytes()
+
+    for type, (name, fmt) in CommandHandler.stat_types.items():
+        if name in stats:
+            data += struct.pack("!B", type) + (struct.pack(fmt, stats[name]) if fmt else pack_str(stats[name]))
+
+    return data
+
+class SimulatorClient(object):
+    ST_WAITVERSION, \
+    ST_WAITSETUP, \
+    ST_WAITLOGIN, \
+    ST_WAITCHARACTER, \
+    ST_PLAY = range(5)
+
+    def __init__(self, server, sock, addr):
+        self.server = server
+        self.socket = sock
+        self.addr = addr
+        self.buffer = bytes()
+        self.state = self.ST_WAITVERSION
+        self.name = None
+
+        self.xpos = self.server.args.map_width // 2
+        self.ypos = self.server.args.map_height // 2
+        self.direction = (1, 0)
+
+        self.next_map = 0.0
+        self.next_scroll = 0.0
+        self.next_stats = 0.0
+
+        self.stats = {
+            "level": 1, "exp": 0, "hp": 50, "maxhp": 50, "sp": 20, "maxsp": 20, "food": 999,
+            "wc": 10, "ac": 5, "dam": 4, "str": 12, "dex": 12, "con": 12, "int": 12, "wis": 12, "pow": 12, "cha": 12,
+        }
+
+        self.packets = 0
+        self.bytes = 0
+
+        self.handlers = {
+            ServerCommands.VERSION: self._handle_VERSION,
+            ServerCommands.SETUP: self._handle_SETUP,
+            ServerCommands.ACCOUNT: self._handle_ACCOUNT,
+        }
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def send_command(self, name, data = bytes()):
+        data = packet_frame(struct.pack("B", command_index(name)) + data)
+        self.socket.sendall(data)
+        self.packets += 1
+        self.bytes += len(data)
+
+    def read(self):
+        data = self.socket.recv(4096)
+
+        if not data:
+            return False
+
+        self.buffer += data
+
+        while len(self.buffer) >= 2:
+            data_len, = struct.unpack("!H", self.buffer[:2])
+
+            if len(self.buffer) < 2 + data_len:
+                break
+
+            cmd, = struct.unpack("B", self.buffer[2:3])
+            data = self.buffer[3:2 + data_len]
+            self.buffer = self.buffer[2 + data_len:]
+
+            if cmd in self.handlers:
+                self.handlers[cmd](data)
+            else:
+                logging.debug("{}: ignoring command {}".format(self.addr, cmd))
+
+        return True
+
+    def _handle_VERSION(self, data):
+        version, = struct.unpack("!L", data[:4])
+        logging.info("{}: client version {}".format(self.addr, version))
+        self.send_command("Version", struct.pack("!L", version))
+        self.state = self.ST_WAITSETUP
+
+    def _handle_SETUP(self, data):
+        self.send_command("Setup", data)
+        self.state = self.ST_WAITLOGIN
+
+    def _handle_ACCOUNT(self, data):
+        type, = struct.unpack("B", data[:1])
+        data = data[1:]
+
+        if type in (ServerCommands.ACCOUNT_LOGIN, ServerCommands.ACCOUNT_REGISTER):
+            data, account = data_get_str(data)
+            logging.info("{}: account login: {}".format(self.addr, account))
+            self.send_characters(account or "simulator")
+            self.state = self.ST_WAITCHARACTER
+        elif type == ServerCommands.ACCOUNT_LOGIN_CHAR:
+            self.name = data.rstrip(b"\0").decode("ascii")
+            logging.info("{}: character login: {}".format(self.addr, self.name))
+            self.send_command("Player info")
+            self.send_command("Player stats", pack_stats(self.stats))
+            self.send_map(CommandHandler.MAP_UPDATE_CMD_NEW)
+            self.state = self.ST_PLAY
+            self.next_map = self.next_scroll = self.next_stats = time.time()
+        else:
+            logging.warning("{}: unsupported account command {}".format(self.addr, type))
+
+    def send_characters(self, account):
+        data = pack_str(account) + pack_str("127.0.0.1") + pack_str("127.0.0.1")
+        data += struct.pack("!Q", int(time.time()))
+
+        for i in range(self.server.args.characters):
+            data += pack_str("human_male") + pack_str("Sim{}".format(i + 1)) + pack_str("Simulation")
+            data += struct.pack("!HB", 0, i + 1)
+
+        self.send_command("Characters list", data)
+
+    def pack_object(self, layer):
+        flags = 0
+        extra = bytes()
+        roll = random.random()
+
+        if roll < self.server.args.name_rate:
+            flags |= CommandHandler.MAP2_FLAG_NAME
+            extra += pack_str("Player{}".format(random.randrange(100))) + pack_str("#ffffff")
+        elif roll < self.server.args.name_rate + self.server.args.target_rate:
+            flags |= CommandHandler.MAP2_FLAG_MORE
+            extra += struct.pack("!L", CommandHandler.MAP2_FLAG2_TARGET)
+            extra += struct.pack("!LB", random.randrange(1, 1 << 16), random.randrange(2))
+
+        return struct.pack("!BH2B", layer, random.randrange(1, 1 << 15), 0, flags) + extra
+
+    def pack_tile(self, x, y):
+        mask = (x << 11) | (y << 6)
+
+        if random.random() < self.server.args.clear_rate:
+            return struct.pack("!H", mask | CommandHandler.MAP2_MASK_CLEAR)
+
+        data = struct.pack("!HB", mask, self.server.args.layers)
+
+        for layer in random.sample(range(1, 8), self.server.args.layers):
+            data += self.pack_object(layer)
+
+        if random.random() < self.server.args.anim_rate:
+            return data + struct.pack("!2BH", CommandHandler.MAP2_FLAG_EXT_ANIM, random.choice([CommandHandler.ANIM_DAMAGE, CommandHandler.ANIM_KILL]), random.randrange(1, 100))
+
+        return data + struct.pack("!B", 0)
+
+    def send_map(self, mapstat):
+        data = struct.pack("!B", mapstat)
+
+        if mapstat == CommandHandler.MAP_UPDATE_CMD_NEW:
+            data += pack_str(self.server.args.map_name) + pack_str("no_music") + pack_str("")
+            data += struct.pack("!4B", self.server.args.map_width, self.server.args.map_height, self.xpos, self.ypos)
+        else:
+            data += struct.pack("!2B", self.xpos, self.ypos)
+
+        num = int(round(17 * 17 * self.server.args.density))
+
+        for i in random.sample(range(17 * 17), num):
+            data += self.pack_tile(i % 17, i // 17)
+
+        self.send_command("Map", data)
+
+    def scroll(self):
+        for i in range(4):
+            x = self.xpos + self.direction[0]
+            y = self.ypos + self.direction[1]
+
+            if 0 <= x < self.server.args.map_width and 0 <= y < self.server.args.map_height:
+                self.xpos, self.ypos = x, y
+                return
+
+            self.direction = random.choice([(1, 0), (-1, 0), (0, 1), (0, -1)])
+
+    def update_stats(self):
+        changed = {}
+        self.stats["hp"] = max(0, min(self.stats["maxhp"], self.stats["hp"] + random.randint(-5, 5)))
+        changed["hp"] = self.stats["hp"]
+
+        if random.random() < 0.5:
+            self.stats["sp"] = max(0, min(self.stats["maxsp"], self.stats["sp"] + random.randint(-3, 3)))
+            changed["sp"] = self.stats["sp"]
+
+        if random.random() < 0.3:
+            self.stats["exp"] += random.randrange(1, 100)
+            changed["exp"] = self.stats["exp"]
+
+        if random.random() < 0.1:
+            self.stats["food"] = max(0, self.stats["food"] - 1)
+            changed["food"] = self.stats["food"]
+
+        self.send_command("Player stats", pack_stats(changed))
+
+    def tick(self, now):
+        if self.state != self.ST_PLAY:
+            return
+
+        if self.server.args.scroll_rate and now >= self.next_scroll:
+            self.next_scroll = now + 1.0 / self.server.args.scroll_rate
+            self.scroll()
+
+        if self.server.args.stats_rate and now >= self.next_stats:
+            self.next_stats = max(self.next_stats + 1.0 / self.server.args.stats_rate, now - 1.0)
+            self.update_stats()
+
+        if now >= self.next_map:
+            self.next_map = max(self.next_map + 1.0 / self.server.args.packet_rate, now - 1.0)
+            self.send_map(CommandHandler.MAP_UPDATE_CMD_SAME)
+
+class SimulatorServer(object):
+    def __init__(self, args):
+        self.args = args
+        self.clients = []
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((args.host, args.port))
+        self.socket.listen(5)
+
+        self.next_stats = time.time() + args.stats_interval
+
+    def drop(self, client, reason):
+        logging.info("{}: disconnected: {}".format(client.addr, reason))
+        client.socket.close()
+        self.clients.remove(client)
+
+    def log_stats(self, now):
+        elapsed = now - self.next_stats + self.args.stats_interval
+        self.next_stats = now + self.args.stats_interval
+
+        for client in self.clients:
+            logging.info("{}: {:.1f} packets/s, {:.1f} KiB/s".format(client.addr, client.packets / elapsed, client.bytes / elapsed / 1024))
+            client.packets = 0
+            client.bytes = 0
+
+    def run(self):
+        logging.info("Listening on {}:{}".format(self.args.host, self.args.port))
+
+        while True:
+            r, w, e = select.select([self.socket] + self.clients, [], [], 0.001)
+
+            for obj in r:
+                if obj is self.socket:
+                    sock, addr = self.socket.accept()
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.clients.append(SimulatorClient(self, sock, addr))
+                    logging.info("{}: connected".format(addr))
+                    continue
+
+                try:
+                    if not obj.read():
+                        self.drop(obj, "connection closed")
+                except (socket.error, struct.error) as e:
+                    self.drop(obj, e)
+
+            now = time.time()
+
+            for client in self.clients[:]:
+                try:
+                    client.tick(now)
+                except socket.error as e:
+                    self.drop(client, e)
+
+            if now >= self.next_stats:
+                self.log_stats(now)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Local stand-in Atrinik server that streams simulated map traffic.")
+    parser.add_argument("--host", default = "localhost")
+    parser.add_argument("--port", type = int, default = 13327)
+    parser.add_argument("--characters", type = int, default = 3, help = "characters in the account")
+    parser.add_argument("--map-name", default = "Simulated Map")
+    parser.add_argument("--map-width", type = int, default = 64)
+    parser.add_argument("--map-height", type = int, default = 64)
+    parser.add_argument("--density", type = float, default = 0.25, help = "fraction of the 17x17 view updated per packet")
+    parser.add_argument("--layers", type = int, default = 2, choices = range(1, 8), metavar = "{1-7}", help = "layers sent per tile")
+    parser.add_argument("--scroll-rate", type = float, default = 2.0, help = "player moves per second")
+    parser.add_argument("--packet-rate", type = float, default = 20.0, help = "map packets per second")
+    parser.add_argument("--anim-rate", type = float, default = 0.02, help = "fraction of tiles with a damage/kill animation")
+    parser.add_argument("--stats-rate", type = float, default = 10.0, help = "partial player stats updates per second")
+    parser.add_argument("--clear-rate", type = float, default = 0.05, help = "fraction of tiles sent as cleared")
+    parser.add_argument("--name-rate", type = float, default = 0.02, help = "fraction of objects with a player name")
+    parser.add_argument("--target-rate", type = float, default = 0.05, help = "fraction of objects with target data")
+    parser.add_argument("--stats-interval", type = float, default = 5.0)
+    args = parser.parse_args()
+
+    if not 0.0 <= args.density <= 1.0:
+        parser.error("argument --density: must be between 0 and 1")
+
+    if args.packet_rate <= 0:
+        parser.error("argument --packet-rate: must be greater than 0")
+
+    logging.basicConfig(level = logging.INFO,
+                        format = "%(asctime)s.%(msecs).03d %(levelname)8s: %(message)s",
+                        datefmt = "%Y-%m-%d %H:%M:%S")
+
+    SimulatorServer(args).run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import socket
+import struct
+import sys
+import time
+import argparse
+
+from main import MapObject, RelayThread
+
+class Spectator(object):
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.buffer = bytes()
+        self.map = MapObject()
+
+    def read_frame(self):
+        while True:
+            if len(self.buffer) >= 2:
+                header_len = 3 if struct.unpack("B", self.buffer[:1])[0] & 0x80 else 2
+
+                if len(self.buffer) >= header_len:
+                    unpacked = struct.unpack("{0}B".format(header_len), self.buffer[:header_len])
+                    data_len = (unpacked[-2] << 8) + unpacked[-1]
+
+                    if header_len == 3:
+                        data_len += (unpacked[-3] & 0x7f) << 16
+
+                    if len(self.buffer) >= header_len + data_len:
+                        data = self.buffer[header_len:header_len + data_len]
+                        self.buffer = self.buffer[header_len + data_len:]
+                        return data
+
+            data = self.socket.recv(4096)
+
+            if not data:
+                return None
+
+            self.buffer += data
+
+    def handle_frame(self, data):
+        type, x, y = struct.unpack("!B2h", data[:5])
+        data = data[5:]
+
+        if type == RelayThread.SNAPSHOT:
+            self.map.tiles = {}
+
+        self.map.pos = [x, y]
+
+        while data:
+            data = self.map.tile_unpack(data)
+
+        self.map.pop_changed()
+
+def main():
+    parser = argparse.ArgumentParser(description = "Watch the map view shared by a client started with --relay.")
+    parser.add_argument("path", help = "relay Unix socket")
+    parser.add_argument("--width", type = int, default = 40)
+    parser.add_argument("--height", type = int, default = 20)
+    parser.add_argument("--fps", type = float, default = 10.0)
+    args = parser.parse_args()
+
+    spectator = Spectator(args.path)
+    next_frame = 0.0
+
+    while True:
+        data = spectator.read_frame()
+
+        if data is None:
+            break
+
+        spectator.handle_frame(data)
+
+        if time.time() >= next_frame:
+            next_frame = time.time() + 1.0 / args.fps
+            sys.stdout.write("\x1b[H\x1b[2J" + spectator.map.render(width = args.width, height = args.height) + "\n")
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()